@@ -2,18 +2,38 @@ import streamlit as st
 import pandas as pd
 import os
 import io
+import hashlib
 import zipfile
 import tempfile
 from google import genai
-from google.genai import types
-import wave
+from google.genai import types, errors
+import httpx
+import struct
+import functools
+import queue
 from dotenv import load_dotenv
 from datetime import datetime
 import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Concurrency settings for batch generation
+MAX_WORKERS = 8  # Number of API calls in flight at once
+HTTP_POOL_SIZE = 16  # HTTP connections kept for the API client (must be >= MAX_WORKERS)
+RATE_LIMIT_CALLS = 40  # Max API call starts per RATE_LIMIT_PERIOD
+RATE_LIMIT_PERIOD = 60.0  # Seconds
+ZIP_SPOOL_SIZE = 128 << 20  # ZIP stays in memory up to this size, then spills to disk
+MAX_RETRIES = 4  # Attempts per API call on timeouts / transient errors
+CACHE_MAX_TEMPERATURE = 0.5  # Results are only cached at or below this temperature
+
 # Initialize Gemini client
 @st.cache_resource
 def init_client():
@@ -26,67 +46,241 @@ def init_client():
     return genai.Client(
         api_key=api_key,
         http_options=types.HttpOptions(
-            client_args={"timeout": 60.0}  # 秒
+            client_args={
+                "timeout": 60.0,  # 秒
+                # One connection per worker, kept alive across rate-limit waits
+                "limits": httpx.Limits(
+                    max_connections=HTTP_POOL_SIZE,
+                    max_keepalive_connections=HTTP_POOL_SIZE,
+                    keepalive_expiry=30.0
+                )
+            }
         )
     )
 
-# Wave file creation function
-def create_wave_file(pcm_data, channels=1, rate=24000, sample_width=2):
-    """Create a wave file in memory from PCM data"""
-    buffer = io.BytesIO()
-    with wave.open(buffer, "wb") as wf:
-        wf.setnchannels(channels)
-        wf.setsampwidth(sample_width)
-        wf.setframerate(rate)
-        wf.writeframes(pcm_data)
-    buffer.seek(0)
-    return buffer
+# Reusable buffers for WAV assembly
+_WAV_POOL = queue.SimpleQueue()
 
-# TTS generation function
-def generate_tts(client, text, voice="Zephyr", instruction="", temperature=1.0, model="gemini-2.5-pro-preview-tts"):
-    """Generate TTS for given text with specified parameters and instructions"""
+def acquire_buf(min_size):
+    """Take a buffer of at least min_size bytes from the pool (or allocate one)"""
     try:
-        # Combine instruction and text if instruction is provided
-        if instruction:
-            contents = f"""# Instructions: {instruction}
+        buf = _WAV_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(min_size)
+    if len(buf) < min_size:
+        # Too small for this clip; replace it with a bigger one
+        return bytearray(min_size)
+    return buf
+
+def release_buf(buf):
+    """Return a buffer to the pool once nothing references it anymore"""
+    _WAV_POOL.put(buf)
+
+# 44-byte RIFF/WAVE header for PCM data
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+# Wave file creation function
+def create_wave_file(pcm_data, channels=1, rate=24000, sample_width=2, buf=None):
+    """Write a RIFF header + PCM data into buf (or a new buffer) and return a memoryview of the WAV"""
+    size = _WAV_HEADER.size + len(pcm_data)
+    if buf is None:
+        buf = bytearray(size)
+    _WAV_HEADER.pack_into(
+        buf, 0,
+        b'RIFF', 36 + len(pcm_data), b'WAVE',
+        b'fmt ', 16, 1, channels, rate,
+        rate * channels * sample_width,  # Byte rate
+        channels * sample_width,  # Block align
+        sample_width * 8,  # Bits per sample
+        b'data', len(pcm_data)
+    )
+    buf[_WAV_HEADER.size:size] = pcm_data
+    return memoryview(buf)[:size]
+
+# ZIP writer run in a background thread during generation
+def zip_writer(clip_queue, zip_file, failed_writes):
+    """Write (index, filename, pcm_data) items from the queue into the ZIP until a None sentinel"""
+    while True:
+        item = clip_queue.get()
+        if item is None:
+            break
+        i, filename, pcm_data = item
+        try:
+            buf = acquire_buf(_WAV_HEADER.size + len(pcm_data))
+            with create_wave_file(pcm_data, buf=buf) as wav_bytes:
+                zip_file.writestr(filename, wav_bytes)
+            release_buf(buf)
+        except Exception as e:
+            logger.exception("ZIP Write Error")
+            failed_writes.append((i, str(e)))
+
+# Read a single generated file back from the ZIP archive
+def read_generated_file(filename):
+    """Read one WAV file from the ZIP kept in session state"""
+    with zipfile.ZipFile(st.session_state.zip_file) as zip_file:
+        return zip_file.read(filename)
+
+# Cached request builders (identical across rows sharing voice/instruction)
+@functools.lru_cache(maxsize=64)
+def _make_config(voice, temperature, timeout):
+    """Build a reusable GenerateContentConfig for the given voice, temperature and timeout (seconds)"""
+    return types.GenerateContentConfig(
+        http_options=types.HttpOptions(timeout=timeout * 1000),  # ミリ秒
+        temperature=temperature,
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            voice_config=types.VoiceConfig(
+                prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                    voice_name=voice,
+                )
+            )
+        ),
+    )
+
+# Prompt template used when an instruction is given
+_TPL = """# Instructions: {instruction}
 
 # Read the following lines according to the instructions above:
 "{text}" """
-        else:
-            contents = text
-        
+
+@functools.lru_cache(maxsize=64)
+def _make_prompt(instruction, text):
+    """Combine instruction and text if instruction is provided"""
+    if not instruction:
+        return text
+    return _TPL.format_map({'instruction': instruction, 'text': text})
+
+# Errors worth retrying: timeouts, 5xx and rate limiting
+def _is_retryable(error):
+    if isinstance(error, (httpx.TimeoutException, errors.ServerError)):
+        return True
+    return _is_rate_limited(error)
+
+def _is_rate_limited(error):
+    return isinstance(error, errors.ClientError) and error.code == 429
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before the next attempt"""
+    if not _is_rate_limited(error):
+        # Timeouts / 5xx: short exponential backoff
+        return 0.5 * 2 ** attempt
+    # 429: honour the server's RetryInfo (e.g. "37s"), else wait out the quota window
+    try:
+        for detail in error.details['error']['details']:
+            if detail.get('@type', '').endswith('RetryInfo'):
+                return float(detail['retryDelay'].rstrip('s'))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+    return RATE_LIMIT_PERIOD
+
+class EmptyResponseError(Exception):
+    """Raised when the API returns no audio (kept out of the cache); args[0] is the finish/block reason"""
+
+# API call with retries
+def _synthesize(_client, text, voice, instruction, temperature, model, _rate_limiter=None):
+    """Call the TTS API and return PCM bytes; raises on failure so errors are never cached"""
+    contents = _make_prompt(instruction, text)
+    # Per-call deadline scaled by prompt length, so stuck requests are retried early
+    timeout = int(max(20, min(120, 0.1 * len(contents) + 15)))
+    config = _make_config(voice, temperature, timeout)
+    
+    for attempt in range(MAX_RETRIES):
+        if _rate_limiter is not None:
+            _rate_limiter.wait()
         print(f"  🔄 Calling API with temperature={temperature}, voice={voice}")
-        
-        response = client.models.generate_content(
-            model=model,
-            contents=contents,
-            config=types.GenerateContentConfig(
-                temperature=temperature,
-                response_modalities=["AUDIO"],
-                speech_config=types.SpeechConfig(
-                    voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                            voice_name=voice,
-                        )
-                    )
-                ),
-            )
-        )
-        
-        if not response or not response.candidates:
-            print(f"  ⚠️ Empty response from API")
-            return None
-            
-        pcm_data = response.candidates[0].content.parts[0].inline_data.data
-        print(f"  ✅ Generated audio ({len(pcm_data)} bytes)")
-        return pcm_data
+        try:
+            # Stream the response and collect audio chunks as they arrive
+            pcm_data = bytearray()
+            finish_reason = None
+            for chunk in _client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            ):
+                if not chunk.candidates:
+                    # Blocked prompts come back without candidates
+                    if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                        finish_reason = chunk.prompt_feedback.block_reason
+                    continue
+                if chunk.candidates[0].finish_reason:
+                    finish_reason = chunk.candidates[0].finish_reason
+                if not chunk.candidates[0].content:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    if part.inline_data and part.inline_data.data:
+                        pcm_data.extend(part.inline_data.data)
+            break
+        except Exception as e:
+            if attempt == MAX_RETRIES - 1 or not _is_retryable(e):
+                raise
+            delay = _retry_delay(e, attempt)
+            print(f"  ⚠️ Retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES - 1}): {e}")
+            time.sleep(delay)
+    
+    if not pcm_data:
+        raise EmptyResponseError(finish_reason)
+    
+    print(f"  ✅ Generated audio ({len(pcm_data)} bytes)")
+    return bytes(pcm_data)
+
+# Same call memoized on the request inputs (client and limiter are not hashed).
+# Process-wide and in memory: up to max_entries clips are kept across sessions.
+_synthesize_cached = st.cache_data(ttl=3600, max_entries=64, show_spinner=False)(_synthesize)
+
+# TTS generation function
+def generate_tts(client, text, voice="Zephyr", instruction="", temperature=1.0, model="gemini-2.5-pro-preview-tts", rate_limiter=None, use_cache=False):
+    """Generate TTS for given text with specified parameters and instructions"""
+    # Only reuse results where output is close to deterministic; higher temperatures get a fresh take
+    synthesize = _synthesize_cached if use_cache and temperature <= CACHE_MAX_TEMPERATURE else _synthesize
+    try:
+        return synthesize(client, text, voice, instruction, temperature, model, _rate_limiter=rate_limiter)
+    except EmptyResponseError as e:
+        reason = e.args[0]
+        print(f"  ⚠️ Empty response from API (reason: {reason})")
+        error_msg = f"エラー ({text[:30]}): 音声が生成されませんでした"
+        if reason:
+            error_msg += f" (finish_reason: {reason})"
+        st.session_state.setdefault('tts_errors', []).append(error_msg)
+        return None
+    except CancelledError:
+        # Batch was stopped while waiting for a rate-limit slot
+        return None
     except Exception as e:
-        import traceback
-        error_msg = f"エラー: {str(e)}\n{traceback.format_exc()}"
-        st.error(error_msg)
-        print(f"TTS Generation Error: {error_msg}")  # Console logging
+        # Full traceback goes to the log; the page gets one summary after the batch
+        logger.exception("TTS Generation Error")
+        st.session_state.setdefault('tts_errors', []).append(f"エラー ({text[:30]}): {str(e)}")
         return None
 
+# Rate limiter shared by generation workers
+class RateLimiter:
+    """Sliding-window limiter: at most max_calls API call starts per period (seconds) across threads"""
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Wake up all waiting callers and make them raise CancelledError"""
+        self._cancelled.set()
+
+    def wait(self):
+        """Block only while the window is full"""
+        while True:
+            if self._cancelled.is_set():
+                raise CancelledError()
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                delay = self.period - (now - self._calls[0])
+            self._cancelled.wait(delay)
+
 # Available voices with descriptions
 VOICE_INFO = {
     # 女性声（Female voices）
@@ -126,6 +320,17 @@ VOICE_INFO = {
 
 VOICE_OPTIONS = list(VOICE_INFO.keys())
 
+# Voice selector labels, e.g. "Zephyr (女性・落ち着いた声)"
+VOICE_DISPLAY_OPTIONS = tuple(f"{voice} ({desc})" for voice, desc in VOICE_INFO.items())
+VOICE_FROM_DISPLAY = {f"{voice} ({desc})": voice for voice, desc in VOICE_INFO.items()}
+
+# CSV parsing (cached by file content)
+@st.cache_data(show_spinner=False)
+def parse_csv(data):
+    """Parse uploaded CSV bytes - utf-8-sig if there is a BOM (Excel), utf-8 otherwise"""
+    encoding = 'utf-8-sig' if data[:3] == b'\xef\xbb\xbf' else 'utf-8'
+    return pd.read_csv(io.BytesIO(data), encoding=encoding)
+
 # Simple authentication
 def check_password():
     """Returns `True` if the user had the correct password."""
@@ -233,12 +438,13 @@ def main():
         
         if uploaded_file is not None:
             try:
-                # Read CSV - try utf-8-sig first (for Excel), then fallback to utf-8
-                try:
-                    df = pd.read_csv(uploaded_file, encoding='utf-8-sig')
-                except:
-                    uploaded_file.seek(0)  # Reset file pointer
-                    df = pd.read_csv(uploaded_file, encoding='utf-8')
+                # Skip re-parsing on reruns while the same file stays uploaded
+                data = uploaded_file.getvalue()
+                csv_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+                if st.session_state.get('csv_hash') == csv_hash:
+                    df = st.session_state.df
+                else:
+                    df = parse_csv(data)
                 
                 # Validate required column
                 if 'text' not in df.columns:
@@ -258,6 +464,7 @@ def main():
                     
                     # Store in session state
                     st.session_state.df = df
+                    st.session_state.csv_hash = csv_hash
                     
             except Exception as e:
                 st.error(f"CSVファイルの読み込みエラー: {str(e)}")
@@ -281,15 +488,14 @@ def main():
         )
         
         # Voice selector with descriptions
-        voice_display_options = [f"{voice} ({desc})" for voice, desc in VOICE_INFO.items()]
         selected_voice_display = st.selectbox(
             "デフォルト話者",
-            voice_display_options,
+            VOICE_DISPLAY_OPTIONS,
             index=0,
             help="生成する音声の話者を選択します。カッコ内は声の特徴です。"
         )
         # Extract voice name from display string
-        default_voice = selected_voice_display.split(" (")[0]
+        default_voice = VOICE_FROM_DISPLAY[selected_voice_display]
         
         # Default instruction
         default_instruction = st.text_area(
@@ -302,6 +508,8 @@ def main():
         
         # Initialize default values for advanced settings
         default_temperature = 1.0
+        compress_zip = False
+        use_cache = True
         
         # Advanced settings in expander
         with st.expander("⚙️ 詳細設定", expanded=False):
@@ -313,6 +521,16 @@ def main():
                 step=0.1,
                 help="低い値でより一貫性のある音声、高い値でより多様な音声が生成されます（標準: 1.0）"
             )
+            use_cache = st.checkbox(
+                "キャッシュを使う",
+                value=True,
+                help=f"温度{CACHE_MAX_TEMPERATURE}以下のとき、同じテキスト・設定の音声を1時間再利用します（API呼び出しを節約）。新しいテイクが欲しい場合はオフにしてください"
+            )
+            compress_zip = st.checkbox(
+                "ZIPを圧縮する",
+                value=False,
+                help="WAV音声はほとんど圧縮されないため、通常はオフのままで問題ありません（オンにすると作成に時間がかかります）"
+            )
         
         st.divider()
         
@@ -326,114 +544,158 @@ def main():
                 # Progress tracking
                 progress_bar = st.progress(0)
                 status_text = st.empty()
-                generated_files = []
                 
-                # Create temporary directory
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    for idx, row in df.iterrows():
-                        # Update progress
-                        progress = (idx + 1) / len(df)
-                        progress_bar.progress(progress)
-                        # Get display filename (handle NaN)
-                        display_filename = row.get('filename')
-                        if pd.isna(display_filename) or str(display_filename).strip() == '':
-                            display_filename = f"audio_{idx+1:03d}"
-                        status_text.text(f"生成中... ({idx + 1}/{len(df)}) - {display_filename}")
-                        
-                        # Get actual voice that will be used
-                        voice_for_log = row.get('voice')
-                        if pd.isna(voice_for_log) or str(voice_for_log).strip() == '':
-                            voice_for_log = default_voice
-                        
-                        # Debug logging
-                        print(f"\n🎯 Processing {idx + 1}/{len(df)}: {display_filename}")
-                        print(f"   Model: {default_model}")
-                        print(f"   Voice: {voice_for_log}")
-                        
-                        # Skip empty text
-                        if pd.isna(row.get('text')) or str(row.get('text')).strip() == '':
-                            st.warning(f"行 {idx + 1}: テキストが空のためスキップしました")
-                            continue
-                        
-                        # Combine default and individual instructions
-                        combined_instruction = ''
-                        if default_instruction:
-                            combined_instruction = default_instruction
-                        
-                        # Check for instruction and handle NaN
-                        individual_instruction = row.get('instruction', '')
-                        if pd.notna(individual_instruction) and str(individual_instruction).strip():
-                            if combined_instruction:
-                                combined_instruction += f"\n{individual_instruction}"
-                            else:
-                                combined_instruction = individual_instruction
+                # Extract columns once instead of building a Series per row
+                texts = df['text'].to_numpy()
+                valid = (df['text'].notna() & (df['text'].astype(str).str.strip() != '')).to_numpy()
+                # Use default voice when CSV value is empty/invalid
+                voices = df['voice'].where(df['voice'].isin(VOICE_OPTIONS), default_voice).to_numpy()
+                names = df['filename'].where(
+                    df['filename'].notna() & (df['filename'].astype(str).str.strip() != ''),
+                    pd.Series([f"audio_{i+1:03d}" for i in range(len(df))], index=df.index)
+                ).to_numpy()
+                # Combine default and individual instructions
+                has_instruction = df['instruction'].notna() & (df['instruction'].astype(str).str.strip() != '')
+                individual_instructions = df['instruction'].where(has_instruction, '').astype(str)
+                if default_instruction:
+                    insts = (default_instruction + '\n' + individual_instructions).where(
+                        has_instruction, default_instruction
+                    ).to_numpy()
+                else:
+                    insts = individual_instructions.to_numpy()
+                
+                # Release the previous batch's archive before building a new one
+                previous_zip = st.session_state.pop('zip_file', None)
+                if previous_zip is not None:
+                    previous_zip.close()
+                st.session_state.generated_files = []
+                st.session_state.tts_errors = []
+                st.session_state.pop('preview_file', None)
+                
+                # ZIP is written as clips arrive; spills to disk past ZIP_SPOOL_SIZE
+                zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+                
+                # WAV PCM barely compresses, so store uncompressed unless asked
+                compression = zipfile.ZIP_DEFLATED if compress_zip else zipfile.ZIP_STORED
+                try:
+                    with zipfile.ZipFile(zip_buffer, 'w', compression) as zip_file:
+                        rate_limiter = RateLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD)
+                        # Attach the script context so workers can use session state and the cache
+                        ctx = get_script_run_ctx()
+                        futures = {}
+                        results = {}
+                        completed = 0
                         
-                        # Use default values when CSV values are empty/invalid
-                        voice_name = row.get('voice')
-                        if pd.isna(voice_name) or str(voice_name).strip() == '' or voice_name not in VOICE_OPTIONS:
-                            voice_name = default_voice
+                        # WAV assembly and ZIP writes run on their own thread
+                        clip_queue = queue.Queue(maxsize=MAX_WORKERS)
+                        failed_writes = []
+                        writer = threading.Thread(target=zip_writer, args=(clip_queue, zip_file, failed_writes))
+                        writer.start()
                         
-                        pcm_data = generate_tts(
-                            client,
-                            row['text'],
-                            voice=voice_name,
-                            instruction=combined_instruction,
-                            temperature=default_temperature,
-                            model=default_model
+                        executor = ThreadPoolExecutor(
+                            max_workers=MAX_WORKERS,
+                            initializer=add_script_run_ctx,
+                            initargs=(None, ctx)
                         )
-                        
-                        if pcm_data:
-                            # Create wave file
-                            wave_buffer = create_wave_file(pcm_data)
-                            # Use default filename if empty
-                            file_base = row.get('filename')
-                            if pd.isna(file_base) or str(file_base).strip() == '':
-                                file_base = f"audio_{idx+1:03d}"
-                            filename = f"{file_base}.wav"
+                        try:
+                            for i in range(len(df)):
+                                file_base = names[i]
+                                voice_name = voices[i]
+                                
+                                # Debug logging
+                                print(f"\n🎯 Queueing {i + 1}/{len(df)}: {file_base}")
+                                print(f"   Model: {default_model}")
+                                print(f"   Voice: {voice_name}")
+                                
+                                # Skip empty text
+                                if not valid[i]:
+                                    st.warning(f"行 {i + 1}: テキストが空のためスキップしました")
+                                    completed += 1
+                                    continue
+                                
+                                future = executor.submit(
+                                    generate_tts,
+                                    client,
+                                    texts[i],
+                                    voice=voice_name,
+                                    instruction=insts[i],
+                                    temperature=default_temperature,
+                                    model=default_model,
+                                    rate_limiter=rate_limiter,
+                                    use_cache=use_cache
+                                )
+                                futures[future] = (i, voice_name, file_base)
                             
-                            # Save to temp directory
-                            file_path = os.path.join(temp_dir, filename)
-                            with open(file_path, 'wb') as f:
-                                f.write(wave_buffer.getvalue())
-                            
-                            generated_files.append({
-                                'filename': filename,
-                                'text': row['text'][:50] + '...' if len(row['text']) > 50 else row['text'],
-                                'voice': voice_name,  # Use the validated voice name
-                                'path': file_path,
-                                'data': wave_buffer.getvalue()
-                            })
+                            # Collect results as they finish
+                            for future in as_completed(futures):
+                                # Pop so the finished future (and its PCM data) can be freed
+                                i, voice_name, file_base = futures.pop(future)
+                                pcm_data = future.result()
+                                
+                                # Update progress
+                                completed += 1
+                                progress_bar.progress(completed / len(df))
+                                status_text.text(f"生成中... ({completed}/{len(df)}) - {file_base}")
+                                
+                                if pcm_data:
+                                    filename = f"{file_base}.wav"
+                                    
+                                    # Hand off to the ZIP writer and go back to waiting on the API
+                                    clip_queue.put((i, filename, pcm_data))
+                                    
+                                    text = texts[i]
+                                    results[i] = {
+                                        'filename': filename,
+                                        'text': text[:50] + '...' if len(text) > 50 else text,
+                                        'voice': voice_name,  # Use the validated voice name
+                                        'size': _WAV_HEADER.size + len(pcm_data)
+                                    }
+                                    del pcm_data
+                        except BaseException:
+                            # Stop button / rerun: cancel queued rows instead of running (and paying for) them
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            rate_limiter.cancel()
+                            raise
+                        else:
+                            executor.shutdown()
+                        finally:
+                            clip_queue.put(None)
+                            writer.join()
                         
-                        # Small delay to avoid rate limiting
-                        time.sleep(1.5)
-                    
-                    # Complete
-                    progress_bar.progress(1.0)
-                    status_text.text("✅ 生成完了！")
-                    
-                    # Store results
-                    st.session_state.generated_files = generated_files
-                    
-                    # Create ZIP file
-                    if generated_files:
-                        zip_buffer = io.BytesIO()
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                            for file_info in generated_files:
-                                zip_file.writestr(file_info['filename'], file_info['data'])
-                        
-                        zip_buffer.seek(0)
-                        st.session_state.zip_data = zip_buffer.getvalue()
+                        # Drop clips that could not be written to the ZIP
+                        for i, error_msg in failed_writes:
+                            st.session_state.tts_errors.append(f"エラー ({results.pop(i)['filename']}): {error_msg}")
+                except BaseException:
+                    zip_buffer.close()
+                    raise
+                
+                # Keep the original CSV order
+                generated_files = [results[i] for i in sorted(results)]
+                
+                # Complete
+                progress_bar.progress(1.0)
+                status_text.text("✅ 生成完了！")
+                if st.session_state.tts_errors:
+                    st.error("\n\n".join(st.session_state.tts_errors))
+                
+                # Store results
+                st.session_state.generated_files = generated_files
+                if generated_files:
+                    st.session_state.zip_file = zip_buffer
+                else:
+                    zip_buffer.close()
             
             # Display results
             if st.session_state.generated_files:
                 st.header("📦 生成結果")
                 
                 # Download all button
-                if 'zip_data' in st.session_state:
+                if 'zip_file' in st.session_state:
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    st.session_state.zip_file.seek(0)
                     st.download_button(
                         label="📥 すべての音声をZIPでダウンロード",
-                        data=st.session_state.zip_data,
+                        data=st.session_state.zip_file.read(),
                         file_name=f"tts_output_{timestamp}.zip",
                         mime="application/zip",
                         type="primary",
@@ -442,18 +704,33 @@ def main():
                 
                 # Individual file preview
                 st.subheader("個別ファイル")
+                # Only the selected file's audio is sent to the browser on each rerun
+                def select_preview(filename):
+                    st.session_state.preview_file = filename
+                
+                preview_file = st.session_state.get('preview_file')
                 for file_info in st.session_state.generated_files:
-                    with st.expander(f"🔊 {file_info['filename']}"):
+                    is_preview = file_info['filename'] == preview_file
+                    with st.expander(f"🔊 {file_info['filename']}", expanded=is_preview):
                         st.text(f"テキスト: {file_info['text']}")
                         st.text(f"話者: {file_info['voice']}")
-                        st.audio(file_info['data'], format='audio/wav')
-                        st.download_button(
-                            label="ダウンロード",
-                            data=file_info['data'],
-                            file_name=file_info['filename'],
-                            mime="audio/wav",
-                            key=f"download_{file_info['filename']}"
-                        )
+                        if is_preview:
+                            wav_data = read_generated_file(file_info['filename'])
+                            st.audio(wav_data, format='audio/wav')
+                            st.download_button(
+                                label="ダウンロード",
+                                data=wav_data,
+                                file_name=file_info['filename'],
+                                mime="audio/wav",
+                                key=f"download_{file_info['filename']}"
+                            )
+                        else:
+                            st.button(
+                                "▶️ 試聴・ダウンロード",
+                                key=f"preview_{file_info['filename']}",
+                                on_click=select_preview,
+                                args=(file_info['filename'],)
+                            )
         else:
             st.info("👈 まずCSVファイルをアップロードしてください。")
 